@@ -2,7 +2,7 @@
 Script para procesar PDFs en lotes con GROBID y guardar resultados en Google Drive.
 
 Flujo:
-1. Instala dependencias necesarias (forzando versión estable de grobid-client).
+1. Instala dependencias necesarias.
 2. Monta Google Drive en Colab.
 3. Procesa PDFs desde /MyDrive/articles.
 4. Guarda TEI y TXT en /MyDrive/results.
@@ -13,68 +13,308 @@ Requisitos:
 
 # grobid_batch_processor.py
 
-import os, shutil, re, time, gc, requests
-import xml.etree.ElementTree as ET
+import os, shutil, re, time, random, subprocess, requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from requests.adapters import HTTPAdapter
+from lxml import etree
 from tqdm import tqdm
-from grobid_client.grobid_client import GrobidClient
+
+GROBID_URL = "http://localhost:8070"
+
+# Staging local: escribir muchos archivos chicos directo a Drive paga la
+# latencia de FUSE por archivo; acá se escriben local y se suben en bloque.
+LOCAL_OUT = "/content/out"
 
 NS = {'tei': 'http://www.tei-c.org/ns/1.0'}
+_TEI = f"{{{NS['tei']}}}"
+
+# Tags de interés precalculados una sola vez (evita armar strings por archivo).
+_STREAM_TAGS = tuple(
+    _TEI + t
+    for t in ("title", "term", "abstract", "body", "head", "p", "label", "list", "figure")
+)
+
+# Opciones del parser compartidas: árboles grandes y sin nodos de espacios.
+_PARSE_OPTS = dict(huge_tree=True, remove_blank_text=True)
+
+# Corte del texto al llegar a referencias/bibliografía (compilado una vez).
+_CUT_RE = re.compile(r"references|bibliography|acknowledg|agradecimientos", re.IGNORECASE)
 
-def is_grobid_alive(url="http://localhost:8070/api/isalive"):
+# Sesión HTTP compartida con keep-alive: el healthcheck y todas las subidas
+# reutilizan las mismas conexiones TCP en vez de abrir una por request.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0))
+SESSION.headers["Connection"] = "keep-alive"
+
+def is_grobid_alive(url=GROBID_URL + "/api/isalive"):
     try:
-        r = requests.get(url, timeout=5)
+        r = SESSION.get(url, timeout=5)
         return r.status_code == 200
     except:
         return False
 
+# Imagen Docker precompilada: arranca en segundos, contra los ~10 minutos
+# de clonar y compilar GROBID con gradle en cada sesión de Colab.
+GROBID_IMAGE = "lfoppiano/grobid:0.7.3"
+
+# Fan-out del cliente: tiene que coincidir con `concurrency` en el
+# grobid.yaml del servidor para saturar su pool de workers sin encolar
+# requests que terminen en timeout.
+GROBID_CONCURRENCY = 10
+
+def start_grobid(image=GROBID_IMAGE, config_path=None):
+    """Levanta el servidor GROBID desde Docker y espera a que responda.
+
+    config_path: un grobid.yaml propio para ajustar el servidor (p.ej.
+    `concurrency` al número de cores y `poolMaxWait: 1` para que la
+    saturación devuelva 503 inmediatos, que el cliente reintenta con
+    backoff). Se monta sobre la configuración del contenedor.
+    """
+    cmd = [
+        "docker", "run", "--rm", "--init",
+        "-p", "8070:8070",
+        "--ulimit", "core=0",
+    ]
+    if config_path is not None:
+        cmd += ["-v", f"{os.path.abspath(config_path)}:/opt/grobid/grobid-home/config/grobid.yaml:ro"]
+    cmd.append(image)
+    proc = subprocess.Popen(cmd)
+    wait_for_grobid()
+    return proc
+
+def wait_for_grobid(timeout=300):
+    """Espera activa hasta que /api/isalive responda, sin sleep fijo."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if is_grobid_alive():
+            return
+        time.sleep(2)
+    raise RuntimeError("GROBID no respondió dentro del tiempo de espera.")
+
 def extract_clean_text(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    content = []
+    with open(xml_path, "rb") as f:
+        return _extract_tei(f)
+
+def extract_clean_text_from_bytes(xml_bytes):
+    return _extract_tei(BytesIO(xml_bytes))
 
-    title = root.find(".//tei:titleStmt/tei:title", NS)
-    if title is not None and title.text:
-        content.append("TITLE: " + title.text.strip())
+def _extract_tei(fobj):
+    tei = _TEI
 
-    kws = root.findall(".//tei:keywords/tei:term", NS)
+    # Una sola pasada streaming sobre el documento: la máquina de estados
+    # junta título, keywords, abstract y los bloques del cuerpo en O(N).
+    title_txt = None
+    abstract_txt = None
+    kws = []
+    parts = []
+    in_body = False
+    saw_body = False
+
+    for event, elem in etree.iterparse(
+        fobj, events=("start", "end"), tag=_STREAM_TAGS, **_PARSE_OPTS
+    ):
+        tag = elem.tag.replace(tei, "")
+        if event == "start":
+            if tag == "body":
+                in_body = True
+                saw_body = True
+            continue
+        if tag == "body":
+            in_body = False
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif in_body:
+            # Sin clear() acá: un <figure>/<list> todavía necesita el texto
+            # de sus hijos; todo se libera junto al cerrar <body>.
+            txt = " ".join(elem.itertext()).strip()
+            if tag == "head" and txt and _CUT_RE.search(txt):
+                # Encabezado de referencias/bibliografía: todo lo que sigue
+                # se descarta igual, así que se corta el parseo acá mismo.
+                break
+            if txt:
+                parts.append(txt)
+        elif tag == "title":
+            parent = elem.getparent()
+            if parent is not None and parent.tag == tei + "titleStmt" and elem.text:
+                title_txt = elem.text.strip()
+            elem.clear()
+        elif tag == "term":
+            if elem.text:
+                kws.append(elem.text.strip())
+            elem.clear()
+        elif tag == "abstract":
+            abstract_txt = " ".join(elem.itertext()).strip()
+            elem.clear()
+
+    content = []
+    if title_txt:
+        content.append("TITLE: " + title_txt)
     if kws:
-        content.append("KEYWORDS: " + ", ".join(kw.text.strip() for kw in kws if kw.text))
-
-    abstract = root.find(".//tei:abstract", NS)
-    if abstract is not None:
-        content.append("ABSTRACT: " + " ".join(abstract.itertext()).strip())
-
-    body = root.find(".//tei:body", NS)
-    if body is not None:
-        parts = []
-        for e in body.iter():
-            tag = e.tag.replace(f"{{{NS['tei']}}}", "")
-            if tag in {"head", "p", "label", "list", "figure"}:
-                txt = " ".join(e.itertext()).strip()
-                if txt:
-                    parts.append(txt)
+        content.append("KEYWORDS: " + ", ".join(kws))
+    if abstract_txt is not None:
+        content.append("ABSTRACT: " + abstract_txt)
+    if saw_body:
         full = "\n\n".join(parts)
-        clean = re.split(r"(references|bibliography|acknowledg|agradecimientos)", full, flags=re.IGNORECASE)[0].strip()
-        content.append(clean)
+        m = _CUT_RE.search(full)
+        content.append(full[:m.start()].strip() if m else full.strip())
 
     return "\n\n".join(content)
 
+# Sin consolidación (lookups a CrossRef), citas crudas, coordenadas ni
+# segmentación de oraciones: son segundos de CPU del servidor por PDF en
+# features que este pipeline no usa aguas abajo.
+_GROBID_FORM = {
+    "consolidateHeader": "0",
+    "consolidateCitations": "0",
+    "includeRawCitations": "0",
+    "segmentSentences": "0",
+}
+
+def _post_pdf(pdf_path, max_retries):
+    """Envía un PDF a GROBID y devuelve (nombre, bytes del TEI, error)."""
+    fname = os.path.basename(pdf_path)
+    url = GROBID_URL + "/api/processFulltextDocument"
+    last_err = None
+    for attempt in range(max_retries):
+        try:
+            with open(pdf_path, "rb", buffering=1 << 16) as f:
+                resp = SESSION.post(
+                    url,
+                    files={"input": (fname, f, "application/pdf")},
+                    data=_GROBID_FORM,
+                    timeout=300,
+                )
+        except Exception as e:
+            # Timeout, corte de conexión o error de lectura del PDF (el FUSE
+            # de Drive es inestable): reintento con backoff exponencial.
+            # Nada sale del worker: un archivo roto no voltea el lote.
+            last_err = e
+            delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+        else:
+            if resp.status_code == 200:
+                return fname, resp.content, None
+            last_err = f"HTTP {resp.status_code}"
+            if resp.status_code in (429, 503):
+                # 503: pool de GROBID saturado, suele liberarse en segundos.
+                # 429: respetar Retry-After si el servidor lo manda.
+                delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+                if "Retry-After" in resp.headers:
+                    try:
+                        delay = int(resp.headers["Retry-After"])
+                    except ValueError:
+                        # El header también puede venir como fecha HTTP:
+                        # en ese caso se mantiene el backoff calculado.
+                        pass
+            else:
+                return fname, None, last_err
+        if attempt < max_retries - 1:
+            time.sleep(delay)
+    return fname, None, last_err
+
+def _extract_one(xml_bytes):
+    """Worker para el pool de procesos: nunca propaga la excepción."""
+    try:
+        return extract_clean_text_from_bytes(xml_bytes), None
+    except Exception as e:
+        # repr y no la excepción: XMLSyntaxError de lxml no es picklable
+        # y rompería el pool al devolver el resultado.
+        return None, repr(e)
+
+def _write_text(path, s):
+    """Escribe un str como UTF-8 en binario, evitando el TextIOWrapper."""
+    with open(path, "wb", buffering=1 << 16) as f:
+        f.write(s.encode("utf-8"))
+
+def _save_batch_results(batch_teis, tei_folder, txt_folder):
+    """Guarda los TEI de un lote (ya en memoria) y extrae el TXT en paralelo.
+
+    batch_teis: lista de (nombre_pdf, bytes_tei).
+    """
+    if not batch_teis:
+        return
+    local_tei = os.path.join(LOCAL_OUT, "tei")
+    local_txt = os.path.join(LOCAL_OUT, "txt")
+    os.makedirs(local_tei, exist_ok=True)
+    os.makedirs(local_txt, exist_ok=True)
+
+    # La extracción es CPU puro sobre documentos independientes:
+    # se reparte entre procesos mientras la escritura queda en el hilo principal.
+    workers = min(len(batch_teis), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = ex.map(_extract_one, (tei for _, tei in batch_teis), chunksize=4)
+        # mininterval alto: menos redibujados del frontend de la notebook
+        # y menos syscalls que refrescar la barra tras cada archivo.
+        for (fname, tei_bytes), (txt, err) in tqdm(
+            zip(batch_teis, results),
+            total=len(batch_teis),
+            desc="Guardando resultados",
+            mininterval=2.0,
+        ):
+            stem = os.path.splitext(fname)[0]
+            with open(os.path.join(local_tei, stem + ".tei.xml"), "wb", buffering=1 << 16) as f:
+                f.write(tei_bytes)
+            if err is not None:
+                print(f"Error procesando {fname}: {err}")
+                continue
+            _write_text(os.path.join(local_txt, stem + ".txt"), txt)
+
+    # Una sola subida en bloque por lote amortiza el costo por archivo de Drive.
+    # Si rsync falla (Drive desmontado, cuota llena), el staging local es la
+    # única copia del lote: se avisa y NO se borra.
+    ok = True
+    for src, dst in ((local_tei, tei_folder), (local_txt, txt_folder)):
+        rc = subprocess.run(["rsync", "-a", src + "/", dst + "/"]).returncode
+        if rc != 0:
+            ok = False
+            print(f"rsync falló (código {rc}) subiendo {src} a {dst}; se conserva la copia local.")
+    if ok:
+        shutil.rmtree(LOCAL_OUT, ignore_errors=True)
+
 def process_pdfs_in_batches(
     input_dir,
     output_dir,
     batch_size=5,
     max_retries=3,
-    restart_every=5
+    restart_every=5,
+    concurrency=GROBID_CONCURRENCY,
+    shard=0,
+    nshards=1
 ):
     tei_folder = os.path.join(output_dir, "articulos_tei")
     txt_folder = os.path.join(output_dir, "articulos_txt")
     os.makedirs(tei_folder, exist_ok=True)
     os.makedirs(txt_folder, exist_ok=True)
 
-    client = GrobidClient(grobid_server="http://localhost:8070", timeout=300)
-    pdfs = [f for f in os.listdir(input_dir) if f.lower().endswith('.pdf')]
+    # scandir aprovecha los DirEntry ya poblados: un solo recorrido del
+    # directorio sin stat extra por archivo (lento sobre Drive/FUSE).
+    with os.scandir(input_dir) as it:
+        pdfs = [e.name for e in it if e.is_file() and e.name.lower().endswith('.pdf')]
     print(f"Se encontraron {len(pdfs)} PDFs.")
 
+    # Particionado: varias sesiones pueden repartirse la misma carpeta de
+    # Drive sin coordinarse corriendo con distinto --shard y el mismo
+    # --nshards. El orden se fija antes de filtrar para que la asignación
+    # sea estable entre corridas.
+    if nshards > 1:
+        pdfs = [p for i, p in enumerate(sorted(pdfs)) if i % nshards == shard]
+        print(f"Shard {shard}/{nshards}: quedan {len(pdfs)} PDFs.")
+
+    # Reanudación: los PDFs que ya tienen TEI en Drive no se reprocesan,
+    # así una corrida cortada se retoma donde quedó.
+    with os.scandir(tei_folder) as it:
+        done = {e.name[:-len(".tei.xml")] for e in it if e.name.endswith(".tei.xml")}
+    if done:
+        antes = len(pdfs)
+        pdfs = [p for p in pdfs if os.path.splitext(p)[0] not in done]
+        print(f"Se omiten {antes - len(pdfs)} PDFs ya procesados.")
+
+    # Un solo hilo guardador: la extracción del lote N corre en segundo plano
+    # mientras GROBID ya está procesando el lote N+1.
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending = None
+
     start = time.time()
     for idx, start_idx in enumerate(range(0, len(pdfs), batch_size)):
         batch = pdfs[start_idx:start_idx + batch_size]
@@ -85,48 +325,52 @@ def process_pdfs_in_batches(
             print("GROBID no disponible. Deteniendo.")
             break
 
-        tmp_input = "/content/tmp_pdfs"
-        tmp_output = "/content/tmp_tei"
-        os.makedirs(tmp_input, exist_ok=True)
-        os.makedirs(tmp_output, exist_ok=True)
-
-        for fname in batch:
-            shutil.copy(os.path.join(input_dir, fname), tmp_input)
-
-        for attempt in range(1, max_retries + 1):
-            try:
-                client.process(
-                    input_path=tmp_input,
-                    output=tmp_output,
-                    service="processFulltextDocument",
-                    consolidate_citations=False
-                )
-                break
-            except Exception as e:
-                print(f"Error en lote (intento {attempt}): {e}")
-                if attempt == max_retries:
-                    print("Saltando lote.")
-                else:
-                    time.sleep(30)
-
-        for fname in tqdm(os.listdir(tmp_output), desc="Guardando resultados"):
-            if fname.endswith(".tei.xml"):
-                xml_path = os.path.join(tmp_output, fname)
-                shutil.copy(xml_path, os.path.join(tei_folder, fname))
+        # POSTs concurrentes: GROBID atiende varios PDFs a la vez con su pool
+        # interno de workers en lugar de recibirlos de a uno. Los PDFs se
+        # leen directo de Drive y los TEI quedan en memoria, sin disco local.
+        pdf_paths = [os.path.join(input_dir, f) for f in batch]
+        batch_teis = []
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(batch))) as ex:
+            futures = {ex.submit(_post_pdf, p, max_retries): p for p in pdf_paths}
+            for fut in as_completed(futures):
                 try:
-                    txt = extract_clean_text(xml_path)
-                    with open(os.path.join(txt_folder, fname.replace(".tei.xml", ".txt")), "w", encoding="utf-8") as f:
-                        f.write(txt)
+                    fname, tei_bytes, err = fut.result()
                 except Exception as e:
-                    print(f"Error procesando {fname}: {e}")
+                    print(f"Error procesando {os.path.basename(futures[fut])} en GROBID: {e}")
+                    continue
+                if err is not None:
+                    print(f"Error procesando {fname} en GROBID: {err}")
+                else:
+                    batch_teis.append((fname, tei_bytes))
 
-        shutil.rmtree(tmp_input, ignore_errors=True)
-        shutil.rmtree(tmp_output, ignore_errors=True)
-        gc.collect()
-        time.sleep(60)
+        if pending is not None:
+            pending.result()
+        pending = saver.submit(_save_batch_results, batch_teis, tei_folder, txt_folder)
 
         if lote_num % restart_every == 0:
             print("¡Sugerencia! Reiniciá GROBID si notás cuelgues.")
 
+    if pending is not None:
+        pending.result()
+    saver.shutdown()
+
     elapsed = time.time() - start
     print(f"\n¡Listo! Procesados {len(pdfs)} PDFs en {elapsed/60:.2f} minutos.")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Procesa PDFs en lotes con GROBID.")
+    parser.add_argument("input_dir", help="Carpeta con los PDFs de entrada")
+    parser.add_argument("output_dir", help="Carpeta donde guardar TEI y TXT")
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--shard", type=int, default=0, help="Índice de esta partición (0..nshards-1)")
+    parser.add_argument("--nshards", type=int, default=1, help="Cantidad total de particiones")
+    args = parser.parse_args()
+    process_pdfs_in_batches(
+        args.input_dir,
+        args.output_dir,
+        batch_size=args.batch_size,
+        shard=args.shard,
+        nshards=args.nshards,
+    )